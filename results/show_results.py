@@ -1,8 +1,8 @@
 import argparse
-import csv
-from collections import defaultdict
+import functools
 
 import numpy as np
+import pandas as pd
 import plotly.graph_objects as go
 
 
@@ -12,37 +12,60 @@ def process_runlog(filename):
     Parameters:
         filename: str
 
-    Returns: dict
-        key: 2-tuple of int
-            (steps, pressed)
-        value: list of float
-            list of results, sorted in descending order; -inf if fault
+    Returns: 2-tuple of dict
+        data: dict
+            key: 2-tuple of int
+                (steps, pressed)
+            value: list of float
+                list of results, sorted in descending order; -inf if fault
+        failed: dict
+            key: 2-tuple of int
+                (steps, pressed)
+            value: bool
+                whether all attempts were faults
     """
-    data = defaultdict(list)
-    with open(filename) as f:
-        reader = csv.reader(f)
-        for line in reader:
-            run = line[1].strip().split(',')
-            steps, pressed = int(run[2]), int(run[3])
+    # 1 MiB read buffer
+    with open(filename, buffering=1 << 20, newline='') as f:
+        df = pd.read_csv(f, header=None, names=['date', 'cmd', 'result', 'replay-filename'])
 
-            result = line[2].strip()
-            if result == 'fault':
-                result = -np.inf
-            else:
-                result = float(result)
+    run = df['cmd'].str.split(',', expand=True)
+    df['steps'], df['pressed'] = run[2].astype(int), run[3].astype(int)
+    df['result'] = pd.to_numeric(df['result'], errors='coerce').fillna(-np.inf)
 
-            data[(steps, pressed)].append(result)
+    # Sort results; groupby keeps the order of rows within each group
+    df = df.sort_values('result', ascending=False)
+    grouped = df.groupby(['steps', 'pressed'])['result']
+    data = grouped.agg(list).to_dict()
 
-    data = dict(data)
+    # Results are sorted, so all attempts were faults if the best one was
+    failed = (grouped.first() == -np.inf).to_dict()
 
-    # Sort results
-    for val_l in data.values():
-        val_l.sort(reverse=True)
+    return data, failed
 
-    return data
 
+@functools.lru_cache(maxsize=8)
+def create_tooltip_texts(data_items, steps_min, pressed_min, num_steps, num_pressed):
+    """Create heatmap tooltip texts.
 
-def plot_data(data):
+    Results are cached, so that plotting the same data again doesn't recreate the texts.
+
+    Parameters:
+        data_items: tuple
+            items of `data` passed to `plot_data`, with lists of results converted to tuples
+        steps_min, pressed_min, num_steps, num_pressed: int
+
+    Returns: np.ndarray of str, shape (num_pressed, num_steps)
+        Shared between calls; must not be modified
+    """
+    tooltip_texts = np.full((num_pressed, num_steps), 'no results', dtype=object)
+    for (steps, pressed), val_l in data_items:
+        results = ', '.join(['fault' if np.isneginf(res) else f'{res:.2f}' for res in val_l])
+        tooltip_texts[pressed-pressed_min, steps-steps_min] = f'<b>results: </b>{results}'
+
+    return tooltip_texts
+
+
+def plot_data(data, failed):
     """
     Parameters:
         data: dict
@@ -50,45 +73,34 @@ def plot_data(data):
                 (steps, pressed)
             value: list of float
                 sorted list of results; -inf if fault
+        failed: dict
+            key: 2-tuple of int
+                (steps, pressed)
+            value: bool
+                whether all attempts were faults
 
     Returns: None
     """
     # Find steps/pressed range
-    steps_min, steps_max, pressed_min, pressed_max = 1_000, 0, 1_000, 0
-    for steps, pressed in data.keys():
-        steps_min = min(steps_min, steps)
-        steps_max = max(steps_max, steps)
-        pressed_min = min(pressed_min, pressed)
-        pressed_max = max(pressed_max, pressed)
+    keys = np.array(list(data.keys()))
+    steps_min, pressed_min = keys.min(axis=0).tolist()
+    steps_max, pressed_max = keys.max(axis=0).tolist()
     num_steps, num_pressed = steps_max - steps_min + 1, pressed_max - pressed_min + 1
 
     # Calculate heatmap data
-    heatmap_data = np.zeros((num_steps, num_pressed))
-    heatmap_data.fill(np.nan)
-    for (steps, pressed), val_l in data.items():
-        heatmap_data[steps-steps_min, pressed-pressed_min] = val_l[0]
+    heatmap_data = np.full((num_steps, num_pressed), np.nan)
+    heatmap_data[keys[:, 0]-steps_min, keys[:, 1]-pressed_min] = [val_l[0] for val_l in data.values()]
 
     # Find failed
     failed_steps, failed_pressed = [], []
-    for (steps, pressed), val_l in data.items():
-        if np.isneginf(val_l).all():
+    for (steps, pressed), all_failed in failed.items():
+        if all_failed:
             failed_steps.append(steps)
             failed_pressed.append(pressed)
 
-    # Create tooltip texts
-    tooltip_texts = []
-    for pressed in range(pressed_min, pressed_max+1):
-        this_line = []
-        for steps in range(steps_min, steps_max+1):
-            text = f'<b>steps: </b>{steps}<br /><b>pressed: </b>{pressed}<br />'
-            results = data.get((steps, pressed))
-            if results is None:
-                text += 'no results'
-            else:
-                text += f'<b>results: </b>' + ', '.join(['fault' if np.isneginf(res) else f'{res:.2f}' for res in results])
-
-            this_line.append(text)
-        tooltip_texts.append(this_line)
+    # Create tooltip texts; steps and pressed are added by `hovertemplate`
+    data_items = tuple((key, tuple(val_l)) for key, val_l in data.items())
+    tooltip_texts = create_tooltip_texts(data_items, steps_min, pressed_min, num_steps, num_pressed)
 
     # Plot heatmap
     common_axis_settings = {
@@ -114,8 +126,8 @@ def plot_data(data):
             zmin=80.,
             zmax=102.,
             colorscale='jet',
-            hoverinfo='text',
-            hovertext=tooltip_texts,
+            text=tooltip_texts,
+            hovertemplate='<b>steps: </b>%{x}<br /><b>pressed: </b>%{y}<br />%{text}<extra></extra>',
             hoverlabel={
                 # 'bgcolor': 'white',
                 'font_size': 16,
@@ -185,9 +197,9 @@ def main():
 
     args = parser.parse_args()
 
-    data = process_runlog(args.runlog_filename)
+    data, failed = process_runlog(args.runlog_filename)
 
-    plot_data(data)
+    plot_data(data, failed)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,382 @@
+"""Settings and helpers shared by run.py and interactive.py."""
+import os
+
+import cv2 as cv
+import numpy as np
+
+
+SERIAL_BAUDRATE = 19200
+
+# Video settings
+VID_WIDTH, VID_HEIGHT, VID_FPS = 1280, 720, 20
+VID_FOURCC = cv.VideoWriter_fourcc(*'MJPG')
+
+VID_OUT_BORDER_L, VID_OUT_BORDER_T, VID_OUT_BORDER_R, VID_OUT_BORDER_B = 182, 60, 1092, 660
+VID_OUT_WIDTH, VID_OUT_HEIGHT = VID_OUT_BORDER_R - VID_OUT_BORDER_L, VID_OUT_BORDER_B - VID_OUT_BORDER_T
+VID_OUT_POSTRUN, VID_OUT_POSTRUN_FAULT = 3., 10.
+# Max number of frames waiting to be written to the output video (2 s of video); capturing blocks when it's full
+VID_OUT_QUEUE_SIZE = 2 * VID_FPS
+VID_OUT_QUEUE_SENTINEL = object()
+
+# CPUs available to the process (Linux only); read at import, before any thread is pinned, because threads inherit
+# the affinity of the thread that starts them
+AVAILABLE_CPUS = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else None
+
+RESULT_TEMPLATE_DIGITS = [str(num) for num in range(10)]
+RESULT_TEMPLATE_STATES = ['practice', 'try-again', 'f', 'm']
+RESULT_TEMPLATE_TYPES = RESULT_TEMPLATE_STATES + RESULT_TEMPLATE_DIGITS
+RESULT_TEMPLATE_HEIGHT = 23
+RESULT_BORDER_EXT_L, RESULT_BORDER_EXT_T, RESULT_BORDER_EXT_R, RESULT_BORDER_EXT_B = 430, 575, 680, 598
+RESULT_BORDER_L, RESULT_BORDER_T, RESULT_BORDER_R, RESULT_BORDER_B = 670, 575, VID_OUT_BORDER_R, 598
+# "practice" is always shown at the same position, so it is searched for only in this part of the extended result area
+RESULT_BORDER_PRACTICE_L, RESULT_BORDER_PRACTICE_R = 430, 630
+# Smallest area containing both result areas; only this area is converted to grayscale
+RESULT_BORDER_ALL_L, RESULT_BORDER_ALL_T = min(RESULT_BORDER_EXT_L, RESULT_BORDER_L), min(RESULT_BORDER_EXT_T, RESULT_BORDER_T)
+RESULT_BORDER_ALL_R, RESULT_BORDER_ALL_B = max(RESULT_BORDER_EXT_R, RESULT_BORDER_R), max(RESULT_BORDER_EXT_B, RESULT_BORDER_B)
+# Shapes of grayscale areas; areas are clipped to the output frame
+RESULT_ALL_SHAPE = (RESULT_BORDER_ALL_B - RESULT_BORDER_ALL_T, min(RESULT_BORDER_ALL_R, VID_OUT_WIDTH) - RESULT_BORDER_ALL_L)
+RESULT_SHAPE = (RESULT_BORDER_B - RESULT_BORDER_T, min(RESULT_BORDER_R, VID_OUT_WIDTH) - RESULT_BORDER_L)
+RESULT_THRESHOLD = 0.95
+# Threshold for state templates matched on downsampled images; a match is then confirmed at full resolution
+RESULT_COARSE_THRESHOLD = 0.7
+# Empty result area is flat (std below 1); templates are searched for only if the std is above this threshold
+RESULT_MIN_STD = 20.
+
+
+def open_video(device_id):
+    """Open video device.
+
+    Parameters:
+        device_id: int
+
+    Returns: cv2.VideoCapture
+    """
+    cap = cv.VideoCapture(device_id)
+    cap.set(cv.CAP_PROP_FOURCC, VID_FOURCC)
+    cap.set(cv.CAP_PROP_FRAME_WIDTH, VID_WIDTH)
+    cap.set(cv.CAP_PROP_FRAME_HEIGHT, VID_HEIGHT)
+    cap.set(cv.CAP_PROP_FPS, VID_FPS)
+
+    return cap
+
+
+def pin_thread(cpus):
+    """Pin the calling thread to `cpus`.
+
+    On Linux, affinity of pid 0 is the calling thread's. CPUs not in AVAILABLE_CPUS are ignored; if none are left, the
+    thread is not pinned.
+
+    Parameters:
+        cpus: set of int
+
+    Returns: None
+    """
+    cpus = cpus & AVAILABLE_CPUS
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
+
+def write_video(out_video, queue, cpus=None):
+    """Thread writing frames to the output video.
+
+    Writes frames read from `queue` to `out_video`.
+
+    Releases `out_video` and terminates when VID_OUT_QUEUE_SENTINEL is received.
+
+    Parameters:
+        out_video: cv2.VideoWriter
+        queue: queue.Queue
+        cpus: set of int or None
+            CPUs the thread is pinned to; None leaves it to the OS
+
+    Returns: None
+    """
+    if cpus is not None:
+        pin_thread(cpus)
+
+    while True:
+        frame = queue.get()
+        if frame is VID_OUT_QUEUE_SENTINEL:
+            break
+
+        out_video.write(frame)
+
+    out_video.release()
+
+
+def prepare_template(template):
+    """Prepare a grayscale template for matching.
+
+    Parameters:
+        template: np.ndarray
+
+    Returns: 2-tuple
+        (zero-mean template as float32, template norm)
+    """
+    template = template.astype(np.float32)
+    template -= template.mean()
+
+    return template, float(np.linalg.norm(template))
+
+
+def prepare_image(image):
+    """Prepare a grayscale image for matching.
+
+    Parameters:
+        image: np.ndarray
+
+    Returns: 2-tuple
+        (image as float32, output of `window_sums`)
+    """
+    image = image.astype(np.float32, copy=False)
+
+    return image, window_sums(image)
+
+
+def crop_image(image, left, right):
+    """Crop a prepared image horizontally.
+
+    Window sums are cumulative, so they are cropped instead of being computed again.
+
+    Parameters:
+        image: 2-tuple
+            Output of `prepare_image`
+        left, right: int
+
+    Returns: 2-tuple
+        Cropped `image`
+    """
+    image, (height, cum_sum, cum_sum_sq) = image
+
+    return image[:, left:right], (height, cum_sum[left:right+1], cum_sum_sq[left:right+1])
+
+
+def window_sums(image):
+    """Cumulative column sums of `image` and of its square.
+
+    Templates span the whole image height, so sums over matching windows are differences of these. They are the last
+    rows of the integral images.
+
+    Parameters:
+        image: np.ndarray
+
+    Returns: 3-tuple
+        (image height, cumulative sum, cumulative sum of squares)
+    """
+    integral, integral_sq = cv.integral2(image, sdepth=cv.CV_64F, sqdepth=cv.CV_64F)
+
+    return image.shape[0], integral[-1], integral_sq[-1]
+
+
+def window_norms(image_sums, width):
+    """Norms of zero-mean matching windows of the given width.
+
+    Parameters:
+        image_sums: 3-tuple
+            Output of `window_sums`
+        width: int
+
+    Returns: np.ndarray, shape (image_width - width + 1,)
+    """
+    height, cum_sum, cum_sum_sq = image_sums
+    wnd_sum = cum_sum[width:] - cum_sum[:-width]
+    wnd_sum_sq = cum_sum_sq[width:] - cum_sum_sq[:-width]
+
+    return np.sqrt(np.maximum(wnd_sum_sq - wnd_sum ** 2 / (height * width), 0.))
+
+
+def result_shown(image):
+    """Check if anything is shown in a result area.
+
+    Templates can't be found in an empty, flat area, so matching can be skipped. The std comes from window sums, so
+    this is cheap.
+
+    Parameters:
+        image: 2-tuple
+            Output of `prepare_image`
+
+    Returns: bool
+    """
+    image, image_sums = image
+    height, width = image.shape
+
+    return bool(window_norms(image_sums, width)[0] > RESULT_MIN_STD * np.sqrt(height * width))
+
+
+def template_found(image, template, threshold=RESULT_THRESHOLD):
+    """Check if `template` is present in `image`; equivalent to thresholding cv.TM_CCOEFF_NORMED.
+
+    Image normalisation comes from window sums, which are computed once per image and shared by all templates.
+
+    Parameters:
+        image: 2-tuple
+            Output of `prepare_image`
+        template: 2-tuple
+            Output of `prepare_template`
+        threshold: float
+
+    Returns: bool
+    """
+    image, image_sums = image
+    template, template_norm = template
+
+    # The template has zero mean, so plain correlation is the TM_CCOEFF numerator
+    corr = cv.matchTemplate(image, template, cv.TM_CCORR)[0]
+    denom = window_norms(image_sums, template.shape[1]) * template_norm
+
+    # Flat windows don't match, as in OpenCV
+    return bool(((corr > threshold * denom) & (denom > 1e-6)).any())
+
+
+def template_found_pyr(images, templates):
+    """Check if a template is present in an image, matching downsampled versions first.
+
+    Most frames are rejected by the cheap match of downsampled (cv.pyrDown) versions; the remaining ones are
+    confirmed at full resolution.
+
+    Parameters:
+        images: 2-tuple
+            (full resolution, downsampled) outputs of `prepare_image`
+        templates: 2-tuple
+            (full resolution, downsampled) outputs of `prepare_template`
+
+    Returns: bool
+    """
+    return template_found(images[1], templates[1], RESULT_COARSE_THRESHOLD) and template_found(images[0], templates[0])
+
+
+def prepare_templates_fft(templates, shape):
+    """Precompute data needed by `match_templates_fft`.
+
+    Parameters:
+        templates: list of 2-tuple
+            Outputs of `prepare_template`; template height must be equal to the height of the searched image
+        shape: 2-tuple of int
+            Shape of the searched image
+
+    Returns: 3-tuple
+        (stacked conjugated spectra of zero-mean templates, list of template widths, list of template norms)
+    """
+    templates_fft = np.conj(np.fft.rfft2(np.stack([np.pad(template, ((0, 0), (0, shape[1] - template.shape[1]))) for template, _ in templates]), s=shape))
+
+    return templates_fft, [template.shape[1] for template, _ in templates], [template_norm for _, template_norm in templates]
+
+
+def match_templates_fft(image, templates_fft):
+    """Match multiple templates against the same image; equivalent to cv.matchTemplate with cv.TM_CCOEFF_NORMED.
+
+    The spectrum of the image and its window sums are computed once and shared by all templates.
+
+    Parameters:
+        image: 2-tuple
+            Output of `prepare_image`
+        templates_fft: 3-tuple
+            Output of `prepare_templates_fft`
+
+    Returns: np.ndarray, shape (num_templates, image_width)
+        Stacked matching results; positions where a template doesn't fit are 0
+    """
+    image, image_sums = image
+    width = image.shape[1]
+    templates_fft, template_widths, template_norms = templates_fft
+
+    # Correlation with all templates in a single inverse transform; only the first row is valid
+    corrs = np.fft.irfft2(np.fft.rfft2(image) * templates_fft, s=image.shape)[:, 0]
+
+    res = np.zeros_like(corrs)
+    for template_idx, (template_width, template_norm) in enumerate(zip(template_widths, template_norms)):
+        num_pos = width - template_width + 1
+        denom = window_norms(image_sums, template_width) * template_norm
+
+        # Flat windows give 0, as in OpenCV
+        np.divide(corrs[template_idx, :num_pos], denom, out=res[template_idx, :num_pos], where=denom > 1e-6)
+
+    return res
+
+
+def read_number(digits_res, min_distance):
+    """Read the number from digit matching results.
+
+    The best matching digit is taken at each position; of matches closer than `min_distance`, only the best one is kept.
+
+    Parameters:
+        digits_res: np.ndarray, shape (10, n)
+            Stacked matching results of digit templates 0-9
+        min_distance: int
+            Minimum distance between two consecutive digits [px]
+
+    Returns: int
+    """
+    best_digit = digits_res.argmax(axis=0)
+    best_score = np.take_along_axis(digits_res, best_digit[np.newaxis], axis=0)[0]
+
+    # (x position, digit) of found digits
+    found = []
+    for x_pos in np.flatnonzero(best_score >= RESULT_THRESHOLD):
+        if found and x_pos - found[-1][0] < min_distance:
+            if best_score[x_pos] > best_score[found[-1][0]]:
+                found[-1] = (x_pos, best_digit[x_pos])
+            continue
+        found.append((x_pos, best_digit[x_pos]))
+
+    result = 0
+    for _, digit in found:
+        result = result * 10 + int(digit)
+
+    return result
+
+
+def load_templates():
+    """Load result templates and prepare them for matching.
+
+    Templates are kept as numpy arrays, not cv.UMat: result areas are only 23 px high, too small for OpenCL transfers
+    to pay off.
+
+    Returns: 3-tuple
+        state_templates: dict
+            key: str
+                state template name
+            value: 2-tuple
+                (full resolution, downsampled) outputs of `prepare_template`
+        digit_templates_fft: 3-tuple
+            Output of `prepare_templates_fft` for digit templates 0-9 and result areas of shape RESULT_SHAPE
+        digit_min_distance: int
+            Minimum distance between two consecutive digits of the result [px]
+    """
+    gray_templates = {t: cv.imread(f'templates/{t}.jpg', cv.IMREAD_GRAYSCALE).astype(np.float32) for t in RESULT_TEMPLATE_TYPES}
+    templates = {t: prepare_template(template) for t, template in gray_templates.items()}
+
+    # State templates are first matched at half resolution
+    state_templates = {t: (templates[t], prepare_template(cv.pyrDown(gray_templates[t]))) for t in RESULT_TEMPLATE_STATES}
+
+    # Digit templates are all matched against the same result area
+    digit_templates_fft = prepare_templates_fft([templates[t] for t in RESULT_TEMPLATE_DIGITS], RESULT_SHAPE)
+    digit_min_distance = min(templates[t][0].shape[1] for t in RESULT_TEMPLATE_DIGITS)
+
+    return state_templates, digit_templates_fft, digit_min_distance
+
+
+def prepare_result_images(gray):
+    """Prepare the result areas of a frame for matching.
+
+    Parameters:
+        gray: np.ndarray, float32, shape RESULT_ALL_SHAPE
+            Grayscale area of the frame containing both result areas
+
+    Returns: 3-tuple
+        (extended result area, result area, "practice" area); each is a 2-tuple of (full resolution, downsampled)
+        outputs of `prepare_image`
+    """
+    result_ext_frame = gray[RESULT_BORDER_EXT_T-RESULT_BORDER_ALL_T:RESULT_BORDER_EXT_B-RESULT_BORDER_ALL_T,
+                            RESULT_BORDER_EXT_L-RESULT_BORDER_ALL_L:RESULT_BORDER_EXT_R-RESULT_BORDER_ALL_L]
+    result_frame = gray[RESULT_BORDER_T-RESULT_BORDER_ALL_T:RESULT_BORDER_B-RESULT_BORDER_ALL_T,
+                        RESULT_BORDER_L-RESULT_BORDER_ALL_L:RESULT_BORDER_R-RESULT_BORDER_ALL_L]
+    result_ext_images = prepare_image(result_ext_frame), prepare_image(cv.pyrDown(result_ext_frame))
+    result_images = prepare_image(result_frame), prepare_image(cv.pyrDown(result_frame))
+
+    # Window sums are cropped along with the images
+    practice_l, practice_r = RESULT_BORDER_PRACTICE_L - RESULT_BORDER_EXT_L, RESULT_BORDER_PRACTICE_R - RESULT_BORDER_EXT_L
+    practice_images = (crop_image(result_ext_images[0], practice_l, practice_r),
+                       crop_image(result_ext_images[1], practice_l // 2, (practice_r + 1) // 2))
+
+    return result_ext_images, result_images, practice_images
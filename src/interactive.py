@@ -41,45 +41,51 @@ Replay filename format: {result}-{counter}.avi
     counter: next available integer that makes the filename unique
 """
 import argparse
-import glob
 import os
 import queue
+import re
 import readline  # command history
 import shutil
 import signal
 import tempfile
 import threading
 import time
+from collections import defaultdict, deque
 from datetime import datetime
 
 import cv2 as cv
 import numpy as np
 import serial
 
+from common import (
+    SERIAL_BAUDRATE, VID_FPS, VID_OUT_BORDER_L, VID_OUT_BORDER_T, VID_OUT_BORDER_R, VID_OUT_BORDER_B, VID_OUT_WIDTH,
+    VID_OUT_HEIGHT, VID_OUT_POSTRUN, VID_OUT_POSTRUN_FAULT, VID_OUT_QUEUE_SIZE, VID_OUT_QUEUE_SENTINEL,
+    RESULT_BORDER_ALL_L, RESULT_BORDER_ALL_T, RESULT_BORDER_ALL_R, RESULT_BORDER_ALL_B, RESULT_ALL_SHAPE,
+    open_video, pin_thread, write_video, load_templates, prepare_result_images, result_shown, template_found_pyr,
+    match_templates_fft, read_number,
+)
+
 
 # Command i/o settings
 STDIN_PROMPT = '> '
-
-SERIAL_BAUDRATE = 19200
+# Max time to wait for the prompt to be shown again [s]; readline doesn't call the pre-input hook if stdin isn't a terminal
+STDIN_PROMPT_TIMEOUT = 0.1
+# Commands passed directly to the serial port
+SERIAL_CMDS = frozenset(['w', 's', 'a', 'd', 'f'])
+# Commands not allowed while recording, in addition to run commands ("r ...")
+RECORDING_BLOCKED_CMDS = SERIAL_CMDS | {'l', 'p'}
 
 _CMD_QUEUE_SENTINEL = object()
 
 
 # Video settings
-VID_WIDTH, VID_HEIGHT, VID_FPS = 1280, 720, 20
-VID_FOURCC = cv.VideoWriter_fourcc(*'MJPG')
-VID_OUT_FOURCC = cv.VideoWriter_fourcc(*'XVID')
-
-VID_OUT_BORDER_L, VID_OUT_BORDER_T, VID_OUT_BORDER_R, VID_OUT_BORDER_B = 182, 60, 1092, 660
-VID_OUT_WIDTH, VID_OUT_HEIGHT = VID_OUT_BORDER_R - VID_OUT_BORDER_L, VID_OUT_BORDER_B - VID_OUT_BORDER_T
-VID_OUT_POSTRUN, VID_OUT_POSTRUN_FAULT = 3., 10.
-
-RESULT_TEMPLATE_DIGITS = [str(num) for num in range(10)]
-RESULT_TEMPLATE_TYPES = ['practice', 'try-again', 'f', 'm'] + RESULT_TEMPLATE_DIGITS
-RESULT_TEMPLATE_HEIGHT = 23
-RESULT_BORDER_EXT_L, RESULT_BORDER_EXT_T, RESULT_BORDER_EXT_R, RESULT_BORDER_EXT_B = 430, 575, 680, 598
-RESULT_BORDER_L, RESULT_BORDER_T, RESULT_BORDER_R, RESULT_BORDER_B = 670, 575, VID_OUT_BORDER_R, 598
-RESULT_THRESHOLD = 0.95
+VID_OUT_FOURCC = cv.VideoWriter_fourcc(*'MJPG')
+# When not recording, decode and process only every n-th frame
+VID_IDLE_DETECT_INTERVAL = 3
+# Min time between preview window updates [s]
+VID_PREVIEW_MIN_PERIOD = 1 / 15
+# CPUs the video and output video writer threads are pinned to, e.g. ({0}, {1}); None leaves it to the OS (Linux only)
+VID_THREAD_CPUS = None
 
 NUM_RECORD_CMDS = 2
 RECORD_START, RECORD_KILL = range(NUM_RECORD_CMDS)
@@ -88,6 +94,8 @@ NUM_VID_STATES = 4
 VID_ST_UNKNOWN, VID_ST_READY_RUN, VID_ST_FINISHED, VID_ST_TRY_AGAIN = range(NUM_VID_STATES)
 
 _REPLAYS_DIRNAME = 'replays'
+# Replay filename: {result}-{counter}.avi
+_REPLAY_FILENAME_RE = re.compile(r'(\S{5})-(\d+)\.avi')
 _RUNLOG_FILENAME = 'runlog.csv'
 
 
@@ -95,7 +103,7 @@ _RUNLOG_FILENAME = 'runlog.csv'
 signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
-def read_stdin(queue):
+def read_stdin(queue, prompt_shown):
     """Thread reading commands from console.
 
     Passes the data read from standard input to `queue` as tuple ('stdin', data).
@@ -103,13 +111,18 @@ def read_stdin(queue):
     Terminates when EOF or 'q' are received on stdin.
 
     Parameters:
-        queue: queue.Queue
+        queue: CmdQueue
+        prompt_shown: threading.Event
+            Set when the prompt is shown and cleared when a command is read
 
     Returns: None
     """
+    readline.set_pre_input_hook(prompt_shown.set)
+
     while True:
         try:
             cmd = input(STDIN_PROMPT).strip()
+            prompt_shown.clear()
             queue.put(('stdin', cmd))
 
             # A workaround to restore console settings
@@ -124,19 +137,19 @@ def read_stdin(queue):
 def read_serial(ser, queue):
     """Thread reading data from the serial port.
 
-    Passes the data read from the serial port to `queue` as tuple ('serial', data).
+    Passes the lines read from the serial port to `queue` as tuple ('serial', data), where data is raw bytes;
+    decoding is left to the consumer.
 
     This function never terminates.
 
     Parameters:
         ser: serial.Serial
-        queue: queue.Queue
+        queue: CmdQueue
 
     Returns: None
     """
     while True:
-        cmd = ser.readline().rstrip().decode()
-        queue.put(('serial', cmd))
+        queue.put(('serial', ser.readline()))
 
 
 def process_video(video_device_id, comm, runlog_filename, replays_dirname):
@@ -152,92 +165,132 @@ def process_video(video_device_id, comm, runlog_filename, replays_dirname):
 
     Returns: None
     """
-    # Result templates
-    templates = {t: cv.imread(f'templates/{t}.jpg') for t in RESULT_TEMPLATE_TYPES}
-
-    # Open video
-    cap = cv.VideoCapture(video_device_id)
-    cap.set(cv.CAP_PROP_FOURCC, VID_FOURCC)
-    cap.set(cv.CAP_PROP_FRAME_WIDTH, VID_WIDTH)
-    cap.set(cv.CAP_PROP_FRAME_HEIGHT, VID_HEIGHT)
-    cap.set(cv.CAP_PROP_FPS, VID_FPS)
-
-    postrun_end_time, curr_result = None, None
-    out_video, out_video_tmp_filename = None, None
-    while True:
-        # Get next frame
-        ret, frame = cap.read()
-        if not ret:
-            continue
-        frame = frame[VID_OUT_BORDER_T:VID_OUT_BORDER_B, VID_OUT_BORDER_L:VID_OUT_BORDER_R]
-
-        result_ext_frame = frame[RESULT_BORDER_EXT_T:RESULT_BORDER_EXT_B, RESULT_BORDER_EXT_L:RESULT_BORDER_EXT_R]
-        result_frame = frame[RESULT_BORDER_T:RESULT_BORDER_B, RESULT_BORDER_L:RESULT_BORDER_R]
-
-        # Get current state
-        res_try_again = np.max(cv.matchTemplate(result_ext_frame, templates['try-again'], cv.TM_CCOEFF_NORMED)) > RESULT_THRESHOLD
-        res_practice = np.max(cv.matchTemplate(result_ext_frame, templates['practice'], cv.TM_CCOEFF_NORMED)) > RESULT_THRESHOLD
-        res_f = np.max(cv.matchTemplate(result_frame, templates['f'], cv.TM_CCOEFF_NORMED)) > RESULT_THRESHOLD
-        res_m = np.max(cv.matchTemplate(result_frame, templates['m'], cv.TM_CCOEFF_NORMED)) > RESULT_THRESHOLD
-
-        if res_try_again:
-            state = VID_ST_TRY_AGAIN
-        elif res_f or res_m:
-            state = VID_ST_FINISHED
-        elif res_practice:
-            state = VID_ST_READY_RUN
-        else:
-            state = VID_ST_UNKNOWN
-
-        with comm:
-            # Notify threads waiting for the state change
-            if state != comm.state:
-                comm.state_changed.notify()
-            comm.state = state
-
-            # Process recording command
-            if comm.record_cmd == RECORD_START:
-                if not comm.recording:
-                    fh, out_video_tmp_filename = tempfile.mkstemp(prefix='replay-', suffix='.avi')
-                    print(f'\rSaving to {out_video_tmp_filename}\n{STDIN_PROMPT}', end='')
-                    os.close(fh)
-                    out_video = cv.VideoWriter(out_video_tmp_filename, VID_OUT_FOURCC, VID_FPS, (VID_OUT_WIDTH, VID_OUT_HEIGHT))
+    writer_cpus = None
+    if VID_THREAD_CPUS is not None:
+        pin_thread(VID_THREAD_CPUS[0])
+        writer_cpus = VID_THREAD_CPUS[1]
+
+    state_templates, digit_templates_fft, digit_min_distance = load_templates()
+
+    cap = open_video(video_device_id)
+
+    # Max replay version per result; replays directory is scanned only once
+    max_versions = defaultdict(int)
+    # Other files, e.g. replays saved by run.py, are skipped
+    for entry in os.scandir(replays_dirname):
+        match = _REPLAY_FILENAME_RE.fullmatch(entry.name)
+        if match:
+            result_str, version = match[1], int(match[2])
+            max_versions[result_str] = max(version, max_versions[result_str])
+
+    # Grayscale result areas are converted into the same buffers in each iteration
+    gray_u8, gray = np.empty(RESULT_ALL_SHAPE, dtype=np.uint8), np.empty(RESULT_ALL_SHAPE, dtype=np.float32)
+
+    # Open runlog; line buffered, so that each result is written immediately
+    runlog_f = open(runlog_filename, 'a', buffering=1)
+    try:
+        frame_idx, last_preview_time = 0, 0.
+        state, recording = VID_ST_UNKNOWN, False
+        postrun_end_time, curr_result = None, None
+        out_video_tmp_filename, out_video_queue, out_video_thread = None, None, None
+        while True:
+            # Every frame is grabbed; outside of recording only every few frames are decoded and processed
+            if not cap.grab():
+                continue
+            frame_idx += 1
+            # Read without the lock: attribute reads are atomic, and a stale value only delays processing by one frame
+            process_frame = comm.recording or comm.record_cmd is not None or frame_idx % VID_IDLE_DETECT_INTERVAL == 0
+            if not process_frame:
+                continue
 
-                    comm.recording, postrun_end_time = True, None
+            # Decode frame
+            ret, frame = cap.retrieve()
+            if not ret:
+                continue
+            # Output area and result areas below are views; grayscale result areas are converted into preallocated buffers
+            frame = frame[VID_OUT_BORDER_T:VID_OUT_BORDER_B, VID_OUT_BORDER_L:VID_OUT_BORDER_R]
+
+            # Once the result of the recorded run is known, the state stays "finished" until the end of the postrun, so
+            # no templates are matched
+            res_f, res_m = False, False
+            if not (recording and postrun_end_time is not None):
+                # Template matching is done on grayscale result areas
+                cv.cvtColor(frame[RESULT_BORDER_ALL_T:RESULT_BORDER_ALL_B, RESULT_BORDER_ALL_L:RESULT_BORDER_ALL_R], cv.COLOR_BGR2GRAY, dst=gray_u8)
+                gray[...] = gray_u8
+                result_ext_images, result_images, practice_images = prepare_result_images(gray)
+
+                # Get current state; templates are matched lazily, in order of state priority
+                shown = result_shown(result_images[0])
+                if template_found_pyr(result_ext_images, state_templates['try-again']):
+                    state = VID_ST_TRY_AGAIN
+                elif shown and template_found_pyr(result_images, state_templates['f']):
+                    state, res_f = VID_ST_FINISHED, True
+                elif shown and template_found_pyr(result_images, state_templates['m']):
+                    state, res_m = VID_ST_FINISHED, True
+                elif template_found_pyr(practice_images, state_templates['practice']):
+                    state = VID_ST_READY_RUN
+                else:
+                    state = VID_ST_UNKNOWN
+
+            # Only state and command exchange is done under the lock; the video thread is the only one that starts and
+            # finishes recordings, so the rest can be done without holding it
+            with comm:
+                # Notify threads waiting for the state change
+                if state != comm.state:
+                    comm.state_changed.notify()
+                comm.state = state
+
+                # Read recording command
+                start_recording = comm.record_cmd == RECORD_START and not comm.recording
+                kill_recording = comm.record_cmd == RECORD_KILL
+                if start_recording:
+                    comm.recording = True
+                elif kill_recording:
+                    comm.run_cmd, comm.record_cmd, comm.recording = None, None, False
+                recording, run_cmd = comm.recording, comm.run_cmd
 
-            elif comm.record_cmd == RECORD_KILL:
-                out_video.release()
+            # Process recording command
+            if start_recording:
+                fh, out_video_tmp_filename = tempfile.mkstemp(prefix='replay-', suffix='.avi')
+                print(f'\rSaving to {out_video_tmp_filename}\n{STDIN_PROMPT}', end='')
+                os.close(fh)
+                out_video = cv.VideoWriter(out_video_tmp_filename, VID_OUT_FOURCC, VID_FPS, (VID_OUT_WIDTH, VID_OUT_HEIGHT))
+
+                # Encode in a separate thread, so that capturing doesn't wait for the encoder
+                out_video_queue = queue.Queue(maxsize=VID_OUT_QUEUE_SIZE)
+                out_video_thread = threading.Thread(target=write_video, args=(out_video, out_video_queue, writer_cpus), daemon=True)
+                out_video_thread.start()
+
+                postrun_end_time = None
+
+            elif kill_recording:
+                out_video_queue.put(VID_OUT_QUEUE_SENTINEL)
+                out_video_thread.join()
                 os.remove(out_video_tmp_filename)
 
-                comm.run_cmd, comm.record_cmd, comm.recording = None, None, False
-
                 print(f'\rRecording killed\n{STDIN_PROMPT}', end='')
 
-            if comm.recording:
-                # Save frame
-                out_video.write(frame)
+            if recording:
+                # Save frame; frames are not modified after being queued, so they are not copied
+                out_video_queue.put(frame)
 
                 # Check if postrun is finished
                 if postrun_end_time is not None and postrun_end_time < time.time():
-                    out_video.release()
-
-                    # Find max version
-                    max_version = 0
-                    for f in glob.iglob(f'{replays_dirname}/{str(curr_result):0>5s}-*.avi'):
-                        f = os.path.basename(f)
-                        version = int(f[6:-4])
-                        max_version = max(version, max_version)
+                    out_video_queue.put(VID_OUT_QUEUE_SENTINEL)
+                    out_video_thread.join()
 
-                    max_version += 1
-                    out_filename = f'{replays_dirname}/{str(curr_result):0>5s}-{max_version:0>2d}.avi'
+                    # Next version
+                    result_str = f'{str(curr_result):0>5s}'
+                    max_versions[result_str] += 1
+                    out_filename = f'{replays_dirname}/{result_str}-{max_versions[result_str]:0>2d}.avi'
                     shutil.move(out_video_tmp_filename, out_filename)
 
                     # Save result to log file
-                    with open(runlog_filename, 'a') as f:
-                        r = curr_result if curr_result == 'fault' else f'{curr_result/100:.2f}'
-                        f.write(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")},"{comm.run_cmd}",{r},{out_filename}\n')
+                    r = curr_result if curr_result == 'fault' else f'{curr_result/100:.2f}'
+                    runlog_f.write(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")},"{run_cmd}",{r},{out_filename}\n')
 
-                    comm.run_cmd, comm.record_cmd, comm.recording = None, None, False
+                    with comm:
+                        comm.run_cmd, comm.record_cmd, comm.recording = None, None, False
 
                     print(f'\rPostrun finished; {out_video_tmp_filename} moved to {out_filename}\n{STDIN_PROMPT}', end='')
 
@@ -251,28 +304,22 @@ def process_video(video_device_id, comm, runlog_filename, replays_dirname):
 
                     elif res_m:
                         # Read the result
-                        res = [cv.matchTemplate(result_frame, templates[t], cv.TM_CCOEFF_NORMED) for t in RESULT_TEMPLATE_DIGITS]
-                        digits_pos_d = {}
-                        for digit, digit_res in enumerate(res):
-                            loc = np.where(digit_res >= RESULT_THRESHOLD)
-                            for x_pos in loc[1]:
-                                digits_pos_d[x_pos] = digit
-
-                        result = 0
-                        for _, digit in sorted(digits_pos_d.items()):
-                            result = result * 10 + digit
+                        res = match_templates_fft(result_images[0], digit_templates_fft)
+                        result = read_number(res, digit_min_distance)
 
                         postrun_end_time = time.time() + VID_OUT_POSTRUN
                         curr_result = result
 
                         print(f'\rSuccessful throw: {result/100:.2f} m.\n{STDIN_PROMPT}', end='')
 
-        # Show preview
-        cv.imshow('C64', frame)
-
-        cv.waitKey(1)
-
-    cap.release()
+            # Show preview; the window is updated at a lower rate than frames are processed
+            if time.time() - last_preview_time > VID_PREVIEW_MIN_PERIOD:
+                last_preview_time = time.time()
+                cv.imshow('C64', frame)
+                cv.waitKey(1)
+    finally:
+        runlog_f.close()
+        cap.release()
 
 
 class VideoComm:
@@ -302,6 +349,32 @@ class VideoComm:
         self._lock.release()
 
 
+class CmdQueue:
+    """Queue used for passing commands from the stdin and serial threads to the main thread.
+
+    Lighter than queue.Queue: `put` is a deque append and an event set. Only one thread may call `get`.
+
+    Attributes:
+        _deque: collections.deque
+        _event: threading.Event
+    """
+    def __init__(self):
+        self._deque = deque()
+        self._event = threading.Event()
+
+    def put(self, item):
+        self._deque.append(item)
+        self._event.set()
+
+    def get(self):
+        # The event is cleared before the deque is checked again, so that no `put` is missed
+        while not self._deque:
+            self._event.wait()
+            self._event.clear()
+
+        return self._deque.popleft()
+
+
 def prepare_for_next_run(ser, video_comm):
     """Skip through finished and 'try again' states.
 
@@ -334,7 +407,7 @@ def process(serial_port, video_device_id, runlog_filename, replays_dirname):
      - reading messages from serial port
      - video analysis
 
-    Communication with the above threads is done via a queue.Queue and a VideoComm.
+    Communication with the above threads is done via a CmdQueue and a VideoComm.
 
     Parameters:
         serial_port: str
@@ -344,11 +417,12 @@ def process(serial_port, video_device_id, runlog_filename, replays_dirname):
 
     Returns: None
     """
-    cmd_queue = queue.Queue()
+    cmd_queue = CmdQueue()
+    prompt_shown = threading.Event()
     video_comm = VideoComm()
 
     with serial.Serial(serial_port, SERIAL_BAUDRATE) as ser:
-        threading.Thread(target=read_stdin, args=(cmd_queue,), daemon=True).start()
+        threading.Thread(target=read_stdin, args=(cmd_queue, prompt_shown), daemon=True).start()
         threading.Thread(target=read_serial, args=(ser, cmd_queue), daemon=True).start()
         threading.Thread(target=process_video, args=(video_device_id, video_comm, runlog_filename, replays_dirname), daemon=True).start()
 
@@ -357,18 +431,18 @@ def process(serial_port, video_device_id, runlog_filename, replays_dirname):
             # Read command
             cmd_src, cmd = cmd_queue.get()
             if cmd_src == 'serial':
-                # Command from serial
-                print(f'\r{cmd}\n{STDIN_PROMPT}', end='')
+                # Command from serial; garbage bytes, e.g. after the Arduino resets, are replaced instead of raising
+                print(f'\r{cmd.rstrip().decode(errors="replace")}\n{STDIN_PROMPT}', end='')
                 continue
-            else:
+            elif cmd is not _CMD_QUEUE_SENTINEL and cmd != 'q':
                 # Command from stdin
-                # Yield control, so that `input` has time to run
-                time.sleep(1e-4)
+                # Wait until `input` shows the prompt again, so that messages are printed after it
+                prompt_shown.wait(STDIN_PROMPT_TIMEOUT)
 
             # Don't process the next command if we are currently recording
             with video_comm:
                 if video_comm.recording and cmd is not _CMD_QUEUE_SENTINEL and (
-                        cmd in ['w', 's', 'a', 'd', 'f', 'l', 'p'] or cmd.startswith('r ')):
+                        cmd in RECORDING_BLOCKED_CMDS or cmd[:2] == 'r '):
                     print(f'\nWe are currently recording; please kill the recording first\n{STDIN_PROMPT}', end='')
                     continue
 
@@ -381,11 +455,11 @@ def process(serial_port, video_device_id, runlog_filename, replays_dirname):
                 print('\rBye')
                 break
 
-            elif cmd in ['w', 's', 'a', 'd', 'f']:
+            elif cmd in SERIAL_CMDS:
                 cmd += '\n'
                 ser.write(cmd.encode())
 
-            elif cmd.startswith('r '):
+            elif cmd[:2] == 'r ':
                 prepare_for_next_run(ser, video_comm)
 
                 with video_comm:
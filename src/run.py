@@ -33,44 +33,51 @@ Replay filename format: {result}-s{steps}-p{pressed}-{counter}.avi
     counter: next available integer that makes the filename unique
 """
 import argparse
-import glob
 import os
+import queue
 import random
+import re
 import shutil
 import tempfile
+import threading
 import time
+from collections import defaultdict
 from datetime import datetime
 
 import cv2 as cv
 import numpy as np
 import serial
 
+from common import (
+    SERIAL_BAUDRATE, VID_FPS, VID_OUT_BORDER_L, VID_OUT_BORDER_T, VID_OUT_BORDER_R, VID_OUT_BORDER_B, VID_OUT_WIDTH,
+    VID_OUT_HEIGHT, VID_OUT_POSTRUN, VID_OUT_POSTRUN_FAULT, VID_OUT_QUEUE_SIZE, VID_OUT_QUEUE_SENTINEL,
+    RESULT_BORDER_T, RESULT_BORDER_L, RESULT_BORDER_R, RESULT_BORDER_B, RESULT_BORDER_ALL_L, RESULT_BORDER_ALL_T,
+    RESULT_BORDER_ALL_R, RESULT_BORDER_ALL_B, RESULT_ALL_SHAPE, RESULT_SHAPE,
+    open_video, write_video, load_templates, prepare_image, prepare_result_images, result_shown, template_found_pyr,
+    match_templates_fft, read_number,
+)
 
-SERIAL_BAUDRATE = 19200
 
 # Video settings
-VID_WIDTH, VID_HEIGHT, VID_FPS = 1280, 720, 20
-VID_FOURCC = cv.VideoWriter_fourcc(*'MJPG')
 VID_OUT_FOURCC = cv.VideoWriter_fourcc(*'XVID')
-
-VID_OUT_BORDER_L, VID_OUT_BORDER_T, VID_OUT_BORDER_R, VID_OUT_BORDER_B = 182, 60, 1092, 660
-VID_OUT_WIDTH, VID_OUT_HEIGHT = VID_OUT_BORDER_R - VID_OUT_BORDER_L, VID_OUT_BORDER_B - VID_OUT_BORDER_T
-VID_OUT_POSTRUN, VID_OUT_POSTRUN_FAULT = 3., 10.
+# Number of decoded frames waiting to be processed
+VID_GRABBER_QUEUE_SIZE = 2
+# Show only every n-th frame in the preview window
+VID_PREVIEW_EVERY_N_FRAMES = 3
 
 MAX_RECORD_TIME = 60.
 
+# While preparing for the next run, process only every n-th frame
+VID_PREPARE_DECODE_INTERVAL = 4
+
 NUM_RUN_STATES = 4
 RUN_ST_UNKNOWN, RUN_ST_READY_RUN, RUN_ST_FINISHED, RUN_ST_TRY_AGAIN = range(NUM_RUN_STATES)
 
-RESULT_TEMPLATE_DIGITS = [str(num) for num in range(10)]
-RESULT_TEMPLATE_TYPES = ['practice', 'try-again', 'f', 'm'] + RESULT_TEMPLATE_DIGITS
-RESULT_TEMPLATE_HEIGHT = 23
-RESULT_BORDER_EXT_L, RESULT_BORDER_EXT_T, RESULT_BORDER_EXT_R, RESULT_BORDER_EXT_B = 430, 575, 680, 598
-RESULT_BORDER_L, RESULT_BORDER_T, RESULT_BORDER_R, RESULT_BORDER_B = 670, 575, VID_OUT_BORDER_R, 598
-RESULT_THRESHOLD = 0.95
-TEMPLATES = {t: cv.imread(f'templates/{t}.jpg') for t in RESULT_TEMPLATE_TYPES}
+STATE_TEMPLATES, DIGIT_TEMPLATES_FFT, RESULT_DIGIT_MIN_DISTANCE = load_templates()
 
 _REPLAYS_DIRNAME = 'replays'
+# Replay filename: {result}-s{steps}-p{pressed}-{counter}.avi
+_REPLAY_FILENAME_RE = re.compile(r'(\S{5}-s\d+-p\d+)-(\d+)\.avi')
 _RUNLOG_FILENAME = 'runlog.csv'
 
 
@@ -95,21 +102,37 @@ PRESSED_PER_STEPS = [
 ]
 
 
-def open_video(device_id):
-    """Open video device.
+class FrameGrabber:
+    """Class reading frames from the video device in a background thread.
 
-    Parameters:
-        device_id: int
+    Frames are decoded while the previous ones are being processed. Provides the part of cv2.VideoCapture interface
+    used in this module.
 
-    Returns: cv2.VideoCapture
+    Attributes:
+        _cap: cv2.VideoCapture
+        _queue: queue.Queue
+        decode_interval: int
+            Only every n-th frame is decoded and returned by `read`; the others are grabbed and dropped
     """
-    cap = cv.VideoCapture(device_id)
-    cap.set(cv.CAP_PROP_FOURCC, VID_FOURCC)
-    cap.set(cv.CAP_PROP_FRAME_WIDTH, VID_WIDTH)
-    cap.set(cv.CAP_PROP_FRAME_HEIGHT, VID_HEIGHT)
-    cap.set(cv.CAP_PROP_FPS, VID_FPS)
+    def __init__(self, cap):
+        self._cap = cap
+        self._queue = queue.Queue(maxsize=VID_GRABBER_QUEUE_SIZE)
+        self.decode_interval = 1
+
+        threading.Thread(target=self._read_frames, daemon=True).start()
+
+    def _read_frames(self):
+        while True:
+            # Skipped frames are only grabbed, so they are not decoded
+            for _ in range(self.decode_interval - 1):
+                self._cap.grab()
+            self._queue.put(self._cap.read())
+
+    def read(self):
+        return self._queue.get()
 
-    return cap
+    def release(self):
+        self._cap.release()
 
 
 def prepare_for_next_run(ser, cap):
@@ -122,9 +145,16 @@ def prepare_for_next_run(ser, cap):
 
     Parameters:
         ser: serial.Serial
-        cap: cv2.VideoCapture
+        cap: FrameGrabber
     """
     print('Preparing for next run')
+
+    # Grayscale result areas are converted into the same buffers in each iteration
+    gray_u8, gray = np.empty(RESULT_ALL_SHAPE, dtype=np.uint8), np.empty(RESULT_ALL_SHAPE, dtype=np.float32)
+
+    # Skip some frames; they are not decoded at all
+    cap.decode_interval = VID_PREPARE_DECODE_INTERVAL
+
     prev_state = None
     while True:
         # Get next frame
@@ -133,26 +163,27 @@ def prepare_for_next_run(ser, cap):
             continue
         frame = frame[VID_OUT_BORDER_T:VID_OUT_BORDER_B, VID_OUT_BORDER_L:VID_OUT_BORDER_R]
 
-        result_ext_frame = frame[RESULT_BORDER_EXT_T:RESULT_BORDER_EXT_B, RESULT_BORDER_EXT_L:RESULT_BORDER_EXT_R]
-        result_frame = frame[RESULT_BORDER_T:RESULT_BORDER_B, RESULT_BORDER_L:RESULT_BORDER_R]
+        # Template matching is done on grayscale result areas
+        cv.cvtColor(frame[RESULT_BORDER_ALL_T:RESULT_BORDER_ALL_B, RESULT_BORDER_ALL_L:RESULT_BORDER_ALL_R], cv.COLOR_BGR2GRAY, dst=gray_u8)
+        gray[...] = gray_u8
+        result_ext_images, result_images, practice_images = prepare_result_images(gray)
 
-        # Get current state
-        res_try_again = np.max(cv.matchTemplate(result_ext_frame, TEMPLATES['try-again'], cv.TM_CCOEFF_NORMED)) > RESULT_THRESHOLD
-        res_practice = np.max(cv.matchTemplate(result_ext_frame, TEMPLATES['practice'], cv.TM_CCOEFF_NORMED)) > RESULT_THRESHOLD
-        res_f = np.max(cv.matchTemplate(result_frame, TEMPLATES['f'], cv.TM_CCOEFF_NORMED)) > RESULT_THRESHOLD
-        res_m = np.max(cv.matchTemplate(result_frame, TEMPLATES['m'], cv.TM_CCOEFF_NORMED)) > RESULT_THRESHOLD
-
-        if res_try_again:
+        # Get current state; templates are matched lazily, in order of state priority
+        shown = result_shown(result_images[0])
+        if template_found_pyr(result_ext_images, STATE_TEMPLATES['try-again']):
             state = RUN_ST_TRY_AGAIN
-        elif res_f or res_m:
+        elif shown and template_found_pyr(result_images, STATE_TEMPLATES['f']):
+            state = RUN_ST_FINISHED
+        elif shown and template_found_pyr(result_images, STATE_TEMPLATES['m']):
             state = RUN_ST_FINISHED
-        elif res_practice:
+        elif template_found_pyr(practice_images, STATE_TEMPLATES['practice']):
             state = RUN_ST_READY_RUN
         else:
             state = RUN_ST_UNKNOWN
 
         if state == RUN_ST_READY_RUN:
             print('Prepared')
+            cap.decode_interval = 1
             break
         elif state in [RUN_ST_FINISHED, RUN_ST_TRY_AGAIN]:
             if state != prev_state:
@@ -166,18 +197,21 @@ def prepare_for_next_run(ser, cap):
             continue
 
 
-def process_throw(cap, run_cmd, num_steps, pressed, runlog_filename, replays_dirname):
+def process_throw(cap, run_cmd, num_steps, pressed, runlog_f, replays_dirname, max_versions):
     """Send the run command and save the result.
 
     Parameters:
-        cap: cv2.VideoCapture
+        cap: FrameGrabber
             Opened video device
         run_cmd: str
             Command to be executed
         num_steps: int
         pressed: int
-        runlog_filename: str
+        runlog_f: file object
+            Opened runlog file
         replays_dirname: str
+        max_versions: defaultdict of int
+            Max replay version per replay filename prefix ("{result}-s{steps}-p{pressed}"); updated in place
 
     Runlog file format (csv):
         date: str
@@ -199,9 +233,18 @@ def process_throw(cap, run_cmd, num_steps, pressed, runlog_filename, replays_dir
     print(f'Saving to {out_video_tmp_filename}')
     os.close(fh)
     out_video = cv.VideoWriter(out_video_tmp_filename, VID_OUT_FOURCC, VID_FPS, (VID_OUT_WIDTH, VID_OUT_HEIGHT))
+    # Encode in a separate thread, so that capturing doesn't wait for the encoder; daemon, so that an error while
+    # recording doesn't leave it blocked forever
+    out_video_queue = queue.Queue(maxsize=VID_OUT_QUEUE_SIZE)
+    out_video_thread = threading.Thread(target=write_video, args=(out_video, out_video_queue), daemon=True)
+    out_video_thread.start()
+
+    # Grayscale result area is converted into the same buffers in each iteration
+    result_frame_u8, result_frame = np.empty(RESULT_SHAPE, dtype=np.uint8), np.empty(RESULT_SHAPE, dtype=np.float32)
 
     start_time = time.time()
     postrun_end_time, curr_result = None, None
+    frame_idx = 0
     while True:
         # Error if recording for too long
         if time.time() - start_time > MAX_RECORD_TIME:
@@ -213,59 +256,47 @@ def process_throw(cap, run_cmd, num_steps, pressed, runlog_filename, replays_dir
             continue
         frame = frame[VID_OUT_BORDER_T:VID_OUT_BORDER_B, VID_OUT_BORDER_L:VID_OUT_BORDER_R]
 
-        result_frame = frame[RESULT_BORDER_T:RESULT_BORDER_B, RESULT_BORDER_L:RESULT_BORDER_R]
-
-        # Save frame
-        out_video.write(frame)
-        cv.imshow('C64', frame)
-
-        # Get current state
-        res_f = np.max(cv.matchTemplate(result_frame, TEMPLATES['f'], cv.TM_CCOEFF_NORMED)) > RESULT_THRESHOLD
-        res_m = np.max(cv.matchTemplate(result_frame, TEMPLATES['m'], cv.TM_CCOEFF_NORMED)) > RESULT_THRESHOLD
+        # Save frame; frames are not modified after being queued, so they are not copied
+        out_video_queue.put(frame)
+        frame_idx += 1
+        if frame_idx % VID_PREVIEW_EVERY_N_FRAMES == 0:
+            cv.imshow('C64', frame)
 
         if postrun_end_time is not None and postrun_end_time < time.time():
-            out_video.release()
-
-            # Find max version
-            max_version = 0
-            for f in glob.iglob(f'{replays_dirname}/{str(curr_result):0>5s}-s{num_steps}-p{pressed}-*.avi'):
-                f = os.path.basename(f)
-                version = int(f[14:-4])
-                max_version = max(version, max_version)
+            out_video_queue.put(VID_OUT_QUEUE_SENTINEL)
+            out_video_thread.join()
 
-            max_version += 1
-            out_filename = f'{replays_dirname}/{str(curr_result):0>5s}-s{num_steps}-p{pressed}-{max_version:0>2d}.avi'
+            # Next version
+            prefix = f'{str(curr_result):0>5s}-s{num_steps}-p{pressed}'
+            max_versions[prefix] += 1
+            out_filename = f'{replays_dirname}/{prefix}-{max_versions[prefix]:0>2d}.avi'
             shutil.move(out_video_tmp_filename, out_filename)
 
             # Save result to log file
-            with open(runlog_filename, 'a') as f:
-                r = curr_result if curr_result == 'fault' else f'{curr_result/100:.2f}'
-                f.write(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")},"{run_cmd}",{r},{out_filename}\n')
+            r = curr_result if curr_result == 'fault' else f'{curr_result/100:.2f}'
+            runlog_f.write(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")},"{run_cmd}",{r},{out_filename}\n')
 
             print(f'Postrun finished; {out_video_tmp_filename} moved to {out_filename}')
 
             return
 
         elif postrun_end_time is None:
+            # Template matching is done on grayscale result area; it is not needed once the result is known
+            cv.cvtColor(frame[RESULT_BORDER_T:RESULT_BORDER_B, RESULT_BORDER_L:RESULT_BORDER_R], cv.COLOR_BGR2GRAY, dst=result_frame_u8)
+            result_frame[...] = result_frame_u8
+            result_images = prepare_image(result_frame), prepare_image(cv.pyrDown(result_frame))
+
             # Check if the run is finished
-            if res_f:
+            shown = result_shown(result_images[0])
+            if shown and template_found_pyr(result_images, STATE_TEMPLATES['f']):
                 postrun_end_time = time.time() + VID_OUT_POSTRUN_FAULT
                 curr_result = 'fault'
 
                 print(f'Failed throw')
 
-            elif res_m:
+            elif shown and template_found_pyr(result_images, STATE_TEMPLATES['m']):
                 # Read the result
-                res = [cv.matchTemplate(result_frame, TEMPLATES[t], cv.TM_CCOEFF_NORMED) for t in RESULT_TEMPLATE_DIGITS]
-                digits_pos_d = {}
-                for digit, digit_res in enumerate(res):
-                    loc = np.where(digit_res >= RESULT_THRESHOLD)
-                    for x_pos in loc[1]:
-                        digits_pos_d[x_pos] = digit
-
-                result = 0
-                for _, digit in sorted(digits_pos_d.items()):
-                    result = result * 10 + digit
+                result = read_number(match_templates_fft(result_images[0], DIGIT_TEMPLATES_FFT), RESULT_DIGIT_MIN_DISTANCE)
 
                 postrun_end_time = time.time() + VID_OUT_POSTRUN
                 curr_result = result
@@ -291,7 +322,7 @@ def process(serial_port, video_device_id, runlog_filename, replays_dirname):
 
     Returns: None
     """
-    # Create a list of allowed steps-pressed pairs
+    # Create arrays of allowed steps-pressed pairs
     states = []
     for step, val in enumerate(PRESSED_PER_STEPS):
         if val is None:
@@ -299,16 +330,29 @@ def process(serial_port, video_device_id, runlog_filename, replays_dirname):
         first, last = val
         for pressed in range(first, last+1):
             states.append((step, pressed))
-
-    cap = open_video(video_device_id)
-    with serial.Serial(serial_port, SERIAL_BAUDRATE) as ser:
+    states_steps = np.fromiter((step for step, _ in states), dtype=np.int16, count=len(states))
+    states_pressed = np.fromiter((pressed for _, pressed in states), dtype=np.int16, count=len(states))
+
+    # Max replay version per filename prefix; replays directory is scanned only once
+    max_versions = defaultdict(int)
+    # Other files, e.g. replays saved by interactive.py, are skipped
+    for entry in os.scandir(replays_dirname):
+        match = _REPLAY_FILENAME_RE.fullmatch(entry.name)
+        if match:
+            prefix, version = match[1], int(match[2])
+            max_versions[prefix] = max(version, max_versions[prefix])
+
+    cap = FrameGrabber(open_video(video_device_id))
+    # Runlog is line buffered, so that each result is written immediately
+    with serial.Serial(serial_port, SERIAL_BAUDRATE) as ser, open(runlog_filename, 'a', buffering=1) as runlog_f:
         while True:
             print('')
 
             # Prepare command
             initial = random.randrange(INITIAL_MIN, INITIAL_MAX+1)
             throw = random.randrange(THROW_MIN, THROW_MAX+1)
-            num_steps, pressed = random.choice(states)
+            state_idx = random.randrange(states_steps.size)
+            num_steps, pressed = int(states_steps[state_idx]), int(states_pressed[state_idx])
 
             cmd = f'r -1,{initial},{num_steps},{pressed},{pressed},0,{throw}\n'.encode()
 
@@ -318,7 +362,7 @@ def process(serial_port, video_device_id, runlog_filename, replays_dirname):
             ser.write(cmd)
 
             # Record throw
-            process_throw(cap, cmd[2:-1].decode(), num_steps, pressed, runlog_filename, replays_dirname)
+            process_throw(cap, cmd[2:-1].decode(), num_steps, pressed, runlog_f, replays_dirname, max_versions)
 
     # This is not reachable
     cap.release()